@@ -0,0 +1,357 @@
+"""Offline benchmark for the NeuraFlix MCP ingest path.
+
+Runs the real tool functions from neuraflix-mcp.py against local stand-ins:
+a fake OMDb/poster HTTP server with configurable latency, an in-memory blob
+container and an in-memory graph that executes the traversals the server
+builds. Reports throughput and p50/p95/p99 latency per stage.
+
+It can also time cold starts: spawning the server over stdio, the way
+neuraflix-mcp.json launches it, until the first list_tools response.
+
+Usage:
+python benchmark.py --workloads 1,10,1000 --omdb-latency 80 --graph-latency 40
+python benchmark.py --workloads 100 --poster-variants 92,185
+python benchmark.py --startup 5
+"""
+import argparse
+import asyncio
+import importlib.util
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import zlib
+from aiohttp import web
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def make_poster():
+    """A real 300x444 JPEG (the size of an OMDb SX300 poster) so variants can be rendered."""
+    from PIL import Image
+
+    base = Image.linear_gradient("L").resize((300, 444))
+    noise = Image.effect_noise((300, 444), 24)
+    image = Image.merge("RGB", (base, noise, Image.blend(base, noise, 0.5)))
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+POSTER_BYTES = make_poster()
+
+def load_server(state_dir):
+    """Import neuraflix-mcp.py with its local state in a scratch directory."""
+    os.environ["NEURAFLIX_STATE_DIR"] = state_dir
+    os.environ.setdefault("OMDB_API_KEY", "bench")
+    os.environ["GREMLIN_HEALTHCHECK_SECS"] = "3600"
+    # the fakes never throttle; keep the token buckets out of the measurement
+    os.environ.setdefault("OMDB_RATE_PER_SEC", "100000")
+    os.environ.setdefault("GREMLIN_RATE_PER_SEC", "100000")
+    spec = importlib.util.spec_from_file_location("neuraflix_mcp", os.path.join(HERE, "neuraflix-mcp.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+# ---------------------------------------------------------------- fake OMDb
+
+PEOPLE = [f"Person {i}" for i in range(60)]
+
+def fake_movie(title, base_url):
+    n = zlib.crc32(title.encode("utf-8"))
+    return {
+        "Title": title,
+        "Year": str(1980 + n % 40),
+        "Genre": "Drama, Adventure",
+        "Director": PEOPLE[n % 10],
+        "Actors": ", ".join(PEOPLE[10 + (n + k * 7) % 50] for k in range(4)),
+        "Poster": f"{base_url}/posters/{n}.jpg",
+        "imdbID": f"tt{n:010d}",
+        "Response": "True",
+    }
+
+async def start_fake_omdb(latency, poster_latency):
+    """Serve OMDb-shaped JSON on / and poster bytes on /posters/*."""
+    state = {}
+
+    async def omdb(request):
+        await asyncio.sleep(latency)
+        title = request.query.get("t") or request.query.get("i", "")
+        return web.json_response(fake_movie(title, state["base_url"]))
+
+    async def poster(request):
+        await asyncio.sleep(poster_latency)
+        return web.Response(body=POSTER_BYTES, content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_get("/", omdb)
+    app.router.add_get("/posters/{name}", poster)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    state["base_url"] = f"http://{host}:{port}"
+    return runner, state["base_url"]
+
+# ---------------------------------------------------------------- fake blob
+
+class FakeBlobClient:
+    def __init__(self, container, name):
+        self.container = container
+        self.name = name
+        self.url = f"memory://posters/{name}"
+
+    async def exists(self):
+        await asyncio.sleep(self.container.latency)
+        return self.name in self.container.blobs
+
+    async def upload_blob(self, data, length=None, overwrite=False, content_settings=None):
+        await asyncio.sleep(self.container.latency)
+        if isinstance(data, (bytes, bytearray)):
+            body = bytes(data)
+        else:
+            body = b"".join([chunk async for chunk in data])
+        self.container.blobs[self.name] = body
+
+class FakeContainerClient:
+    def __init__(self, latency):
+        self.latency = latency
+        self.blobs = {}
+
+    def get_blob_client(self, name):
+        return FakeBlobClient(self, name)
+
+    async def close(self):
+        pass
+
+# ---------------------------------------------------------------- fake graph
+
+class _Result:
+    def __init__(self, value):
+        self.value = value
+
+    def all(self):
+        return self
+
+    def result(self):
+        return self.value
+
+class FakeGremlinClient:
+    """In-memory graph answering the traversals neuraflix-mcp.py submits.
+
+    Scripts are recognised by shape and executed against their bindings;
+    each submit sleeps `latency` seconds to stand in for a Cosmos round-trip.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.vertices = {}
+        self.edges = set()
+        self.submits = 0
+
+    def submit(self, script, bindings=None):
+        time.sleep(self.latency)
+        self.submits += 1
+        bindings = bindings or {}
+        if script.strip() == "g.inject(1)":
+            return _Result([1])
+        if ".values('fingerprint')" in script:
+            vertex = self.vertices.get(("movie", bindings["mid"]))
+            return _Result([vertex["fingerprint"]] if vertex and "fingerprint" in vertex else [])
+        if "hasLabel('director','actor')" in script:
+            people = [{"label": label, "id": vid} for label, vid in self.vertices if label != "movie"]
+            return _Result(people[: bindings.get("n", len(people))])
+        if "addV('movie')" in script:
+            return _Result(self._upsert_movie(script, bindings))
+        raise ValueError(f"FakeGremlinClient does not understand: {script[:80]}")
+
+    def _upsert_movie(self, script, bindings):
+        mid = bindings["mid"]
+        movie = self.vertices.setdefault(("movie", mid), {})
+        movie.update({k: v for k, v in bindings.items() if not re.match(r"[ad]\d+_", k) and k not in ("mid", "lid")})
+        self.vertices.pop(("movie", bindings.get("lid")), None)
+        last = [movie]
+        for prefix, label, edge in (("d", "director", "Directed"), ("a", "actor", "ActedIn")):
+            i = 0
+            while f"{prefix}{i}_id" in bindings:
+                key = (label, bindings[f"{prefix}{i}_id"])
+                if key not in self.vertices:
+                    if f"{prefix}{i}_name" not in bindings:
+                        return []  # lookup of a known vertex found nothing
+                    self.vertices[key] = {"name": bindings[f"{prefix}{i}_name"]}
+                self.edges.add((edge, key[1], mid))
+                last = [edge]
+                i += 1
+        return last
+
+    def close(self):
+        pass
+
+# ---------------------------------------------------------------- cold start
+
+# what `mcp run neuraflix-mcp.py` does: import the file and serve over stdio
+STDIO_LAUNCHER = (
+    "import importlib.util, sys;"
+    "spec = importlib.util.spec_from_file_location('server', sys.argv[1]);"
+    "module = importlib.util.module_from_spec(spec);"
+    "spec.loader.exec_module(module);"
+    "module.mcp.run('stdio')"
+)
+
+async def measure_startup(runs, state_dir):
+    """Seconds from spawning the stdio server to its first list_tools answer."""
+    from mcp import ClientSession, StdioServerParameters
+    from mcp.client.stdio import stdio_client
+
+    params = StdioServerParameters(
+        command=sys.executable,
+        args=["-c", STDIO_LAUNCHER, os.path.join(HERE, "neuraflix-mcp.py")],
+        cwd=HERE,
+        env={**os.environ, "NEURAFLIX_STATE_DIR": state_dir},
+    )
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        async with stdio_client(params) as (read_stream, write_stream):
+            async with ClientSession(read_stream, write_stream) as session:
+                await session.initialize()
+                tools = await session.list_tools()
+                samples.append(time.perf_counter() - start)
+    print(f"== cold start to list_tools ({len(tools.tools)} tools), {runs} run(s)")
+    print(f"  min={min(samples) * 1000:.0f}ms p50={percentile(samples, 50) * 1000:.0f}ms "
+          f"max={max(samples) * 1000:.0f}ms")
+    return samples
+
+# ---------------------------------------------------------------- harness
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+def instrument(server, timings):
+    """Wrap the stage functions of the server module with wall-clock timers."""
+    stages = {
+        "omdb_fetch": "fetch_omdb",
+        "poster_transfer": "upload_poster",
+        "graph_write": "gremlin_insert",
+    }
+    for stage, attr in stages.items():
+        original = getattr(server, attr)
+
+        async def timed(*args, _original=original, _stage=stage, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await _original(*args, **kwargs)
+            finally:
+                timings.setdefault(_stage, []).append(time.perf_counter() - start)
+
+        setattr(server, attr, timed)
+
+async def run_workload(server, size, timings, mode):
+    titles = [f"Bench Movie {size}-{i}" for i in range(size)]
+    start = time.perf_counter()
+    if mode == "bulk":
+        path = os.path.join(server.STATE_DIR, f"bench-{size}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(titles))
+        await server.bulk_ingest(path)
+    else:
+        async def one(title):
+            t0 = time.perf_counter()
+            try:
+                return await server.insert_movie_with_details(title)
+            finally:
+                timings.setdefault("title_total", []).append(time.perf_counter() - t0)
+
+        await server.run_bounded(one, titles, server.INGEST_CONCURRENCY)
+    return time.perf_counter() - start
+
+async def main(args):
+    if args.startup:
+        samples = await measure_startup(args.startup, tempfile.mkdtemp(prefix="neuraflix-bench-"))
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"startup_seconds": samples}, f, indent=2)
+        return
+
+    if args.omdb_rate:
+        os.environ["OMDB_RATE_PER_SEC"] = str(args.omdb_rate)
+    if args.gremlin_rate:
+        os.environ["GREMLIN_RATE_PER_SEC"] = str(args.gremlin_rate)
+    if args.poster_variants:
+        os.environ["POSTER_VARIANTS"] = args.poster_variants
+    server = load_server(tempfile.mkdtemp(prefix="neuraflix-bench-"))
+    runner, base_url = await start_fake_omdb(args.omdb_latency / 1000, args.poster_latency / 1000)
+    server.OMDB_BASE_URL = base_url
+    server._container_client = FakeContainerClient(args.blob_latency / 1000)
+    server._gremlin_client = graph = FakeGremlinClient(args.graph_latency / 1000)
+
+    timings = {}
+    instrument(server, timings)
+    report = []
+    try:
+        for size in args.workloads:
+            timings.clear()
+            elapsed = await run_workload(server, size, timings, args.mode)
+
+            row = {
+                "titles": size,
+                "seconds": round(elapsed, 3),
+                "titles_per_sec": round(size / elapsed, 2) if elapsed else None,
+                "stages": {
+                    stage: {
+                        "count": len(samples),
+                        "p50_ms": round(percentile(samples, 50) * 1000, 1),
+                        "p95_ms": round(percentile(samples, 95) * 1000, 1),
+                        "p99_ms": round(percentile(samples, 99) * 1000, 1),
+                    }
+                    for stage, samples in sorted(timings.items())
+                },
+            }
+            report.append(row)
+            print(f"\n== {size} title(s), {args.mode} mode: {row['seconds']}s, {row['titles_per_sec']} titles/s")
+            for stage, s in row["stages"].items():
+                print(f"  {stage:<16} n={s['count']:<6} p50={s['p50_ms']:>8}ms "
+                      f"p95={s['p95_ms']:>8}ms p99={s['p99_ms']:>8}ms")
+        blobs = server._container_client.blobs
+        print(f"\ngraph submits: {graph.submits}, blobs stored: {len(blobs)}")
+        sizes = {}
+        for name, body in blobs.items():
+            kind = name.rsplit("_", 1)[1].split(".")[0] if "_w" in name else "original"
+            sizes.setdefault(kind, []).append(len(body))
+        for kind, values in sorted(sizes.items()):
+            print(f"  {kind:<10} n={len(values):<6} avg={sum(values) / len(values) / 1024:.1f}KiB")
+    finally:
+        await server.run_shutdown_hooks()
+        await runner.cleanup()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workloads", default="1,10,1000",
+                        type=lambda v: [int(x) for x in v.split(",") if x])
+    parser.add_argument("--mode", choices=("tool", "bulk"), default="tool",
+                        help="tool: insert_movie_with_details fan-out; bulk: bulk_ingest pipeline")
+    parser.add_argument("--omdb-latency", type=float, default=80, help="ms per OMDb request")
+    parser.add_argument("--poster-latency", type=float, default=60, help="ms per poster download")
+    parser.add_argument("--blob-latency", type=float, default=30, help="ms per blob call")
+    parser.add_argument("--graph-latency", type=float, default=40, help="ms per graph traversal")
+    parser.add_argument("--omdb-rate", type=float,
+                        help="OMDb requests/s allowed by the server's limiter (default: unlimited)")
+    parser.add_argument("--gremlin-rate", type=float,
+                        help="graph traversals/s allowed by the server's limiter (default: unlimited)")
+    parser.add_argument("--poster-variants", metavar="WIDTHS",
+                        help="render WebP poster variants at these widths, e.g. 92,185")
+    parser.add_argument("--startup", type=int, metavar="RUNS",
+                        help="only time RUNS stdio cold starts until the first list_tools response")
+    parser.add_argument("--json", help="also write the report to this file")
+    asyncio.run(main(parser.parse_args()))
@@ -1,240 +1,2022 @@
-import os, httpx, tempfile, asyncio, traceback
+import os, httpx, asyncio, traceback, threading, time, json, sqlite3, hashlib, csv, re, functools, random, copy, inspect, difflib, socket
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+from urllib.parse import urlparse
 from uuid import uuid4
-from mcp.server.fastmcp import FastMCP
+from cachetools import LRUCache
+from mcp.server.fastmcp import Context, FastMCP
 from dotenv import load_dotenv
-from azure.storage.blob import BlobServiceClient
-from gremlin_python.driver.client import Client
-from gremlin_python.driver.serializer import GraphSONSerializersV2d0
+from pydantic import BaseModel, Field
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from starlette.responses import Response
+
+# Azure, Gremlin and LangChain are imported where they are first used, so
+# `mcp run` can answer list_tools without paying for them.
 
 load_dotenv()
 
+# Backend clients are shared by every session of the process and released by
+# the hooks below once the last session ends.
+_shutdown_hooks = []
+_active_sessions = 0
+
+def on_shutdown(fn):
+    _shutdown_hooks.append(fn)
+    return fn
+
+async def run_shutdown_hooks():
+    for hook in reversed(_shutdown_hooks):
+        try:
+            await hook()
+        except Exception as e:
+            print(f"[Shutdown] {hook.__name__} failed:", e)
+
+@asynccontextmanager
+async def server_lifespan(server):
+    global _active_sessions
+    _active_sessions += 1
+    if _active_sessions == 1:
+        await start_job_workers()
+        if KNOWN_VERTEX_WARM and not known_vertices:
+            start_known_vertex_warmup()
+    try:
+        yield {}
+    finally:
+        _active_sessions -= 1
+        if _active_sessions == 0:
+            await run_shutdown_hooks()
+
+# transport settings for `python neuraflix-mcp.py` (stdio, sse or streamable-http)
+MCP_TRANSPORT = os.getenv("MCP_TRANSPORT", "sse")
+MCP_HOST = os.getenv("MCP_HOST", "0.0.0.0")
+MCP_PORT = int(os.getenv("MCP_PORT", "8000"))
+# server processes behind the HTTP port; only streamable-http can use more than one
+MCP_WORKERS = int(os.getenv("MCP_WORKERS", "1"))
+# streamable-http without per-client sessions, so any worker can serve any request
+MCP_STATELESS_HTTP = os.getenv("MCP_STATELESS_HTTP", "1") == "1"
+
 # mcp = FastMCP("neuraflix-mcp")
 mcp = FastMCP(
     name="NeuraFlixMCP",
-    host="0.0.0.0",  # only used for SSE transport (localhost)
-    port=8000,  # only used for SSE transport (set this to any port)
+    host=MCP_HOST,  # only used for HTTP transports
+    port=MCP_PORT,  # only used for HTTP transports
+    stateless_http=MCP_STATELESS_HTTP,
+    lifespan=server_lifespan,
 )
 
 OMDB_API_KEY = os.getenv("OMDB_API_KEY")
 OMDB_BASE_URL = "http://www.omdbapi.com"
 
-def run_blocking(fn, *args, **kwargs):
-    return asyncio.get_running_loop().run_in_executor(None, lambda: fn(*args, **kwargs))
+# websocket connections kept open to Cosmos by the shared Gremlin client
+GREMLIN_POOL_SIZE = int(os.getenv("GREMLIN_POOL_SIZE", "4"))
+# probe the pool with a no-op traversal if it sat idle longer than this
+GREMLIN_HEALTHCHECK_SECS = float(os.getenv("GREMLIN_HEALTHCHECK_SECS", "60"))
+
+# shared HTTP client used for OMDb and poster downloads
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1"
+
+# posters are piped from the CDN to Blob Storage in chunks of this size
+POSTER_CHUNK_SIZE = int(os.getenv("POSTER_CHUNK_SIZE", str(64 * 1024)))
+# comma-separated widths of WebP poster variants, e.g. "92,185"; empty disables them
+POSTER_VARIANTS = sorted({int(w) for w in os.getenv("POSTER_VARIANTS", "").split(",") if w.strip()})
+POSTER_VARIANT_QUALITY = int(os.getenv("POSTER_VARIANT_QUALITY", "75"))
+# processes resizing posters (0 = one per CPU)
+POSTER_VARIANT_PROCESSES = int(os.getenv("POSTER_VARIANT_PROCESSES", "0"))
 
-async def fetch_omdb(title):
-    params = {"t": title, "apikey": OMDB_API_KEY}
-    async with httpx.AsyncClient(timeout=15) as client:
+# local state (caches, indexes, jobs) lives under this directory...
+STATE_DIR = os.getenv("NEURAFLIX_STATE_DIR", ".neuraflix")
+# ...unless a shared backend is configured: sqlite:///path/to/file or redis://host:6379/0
+STATE_URL = os.getenv("NEURAFLIX_STATE_URL", "")
+
+# OMDb responses: in-memory LRU in front of a SQLite table, misses kept shorter
+OMDB_CACHE_SIZE = int(os.getenv("OMDB_CACHE_SIZE", "2048"))
+OMDB_CACHE_TTL = float(os.getenv("OMDB_CACHE_TTL", str(7 * 24 * 3600)))
+OMDB_NEGATIVE_TTL = float(os.getenv("OMDB_NEGATIVE_TTL", "3600"))
+OMDB_CACHE_MAX_ROWS = int(os.getenv("OMDB_CACHE_MAX_ROWS", "100000"))
+
+# titles resolved to IMDb ids locally; fuzzy matches must score at least this
+TITLE_FUZZY_CUTOFF = float(os.getenv("TITLE_FUZZY_CUTOFF", "0.92"))
+
+# LLM title extraction results, keyed on the normalized prompt
+TITLE_CACHE_SIZE = int(os.getenv("TITLE_CACHE_SIZE", "512"))
+TITLE_CACHE_TTL = float(os.getenv("TITLE_CACHE_TTL", str(24 * 3600)))
+TITLE_CACHE_MAX_ROWS = int(os.getenv("TITLE_CACHE_MAX_ROWS", "10000"))
+
+# people vertices remembered as existing, optionally preloaded from the graph
+KNOWN_VERTEX_CACHE_SIZE = int(os.getenv("KNOWN_VERTEX_CACHE_SIZE", "50000"))
+KNOWN_VERTEX_WARM = os.getenv("KNOWN_VERTEX_WARM", "0") == "1"
+
+# max titles ingested at once by the multi-movie tools
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "5"))
+
+# background ingest jobs: worker count and how long finished jobs are kept
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_RETENTION_SECS = float(os.getenv("JOB_RETENTION_SECS", str(7 * 24 * 3600)))
+# a running job is owned by one server process; a heartbeat renews its lease
+JOB_LEASE_SECS = float(os.getenv("JOB_LEASE_SECS", "300"))
+
+# bulk ingest: workers per pipeline stage and queue size between stages
+BULK_FETCH_WORKERS = max(1, int(os.getenv("BULK_FETCH_WORKERS", "8")))
+BULK_POSTER_WORKERS = max(1, int(os.getenv("BULK_POSTER_WORKERS", "8")))
+BULK_GRAPH_WORKERS = max(1, int(os.getenv("BULK_GRAPH_WORKERS", "4")))
+BULK_QUEUE_SIZE = int(os.getenv("BULK_QUEUE_SIZE", "100"))
+# the bulk_ingest_movies tool only reads files below this directory
+BULK_INGEST_DIR = os.getenv("BULK_INGEST_DIR", "ingest")
+
+# per-backend request rate (adapted down on throttling, back up on success)
+OMDB_RATE_PER_SEC = float(os.getenv("OMDB_RATE_PER_SEC", "10"))
+GREMLIN_RATE_PER_SEC = float(os.getenv("GREMLIN_RATE_PER_SEC", "50"))
+# retries with jittered exponential backoff for throttled/unavailable backends
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "5"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "30"))
+# consecutive failures that open a backend's circuit, and how long it stays open
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "5"))
+BREAKER_RESET_SECS = float(os.getenv("BREAKER_RESET_SECS", "30"))
+
+# threads for blocking backend calls (Gremlin driver, SQLite)
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", str(min(32, (os.cpu_count() or 1) + 4))))
+# export an OpenTelemetry span per tool call and stage (needs opentelemetry-api)
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "0") == "1"
+
+STAGE_LATENCY = Histogram(
+    "neuraflix_stage_seconds", "Latency of ingest stages and backend calls", ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+STAGE_ERRORS = Counter("neuraflix_stage_errors_total", "Ingest stage calls that raised", ["stage"])
+CACHE_REQUESTS = Counter("neuraflix_cache_requests_total", "Local cache lookups", ["cache", "result"])
+EXECUTOR_QUEUE = Gauge(
+    "neuraflix_executor_queue_depth", "Blocking calls waiting for an executor thread",
+    multiprocess_mode="livesum",
+)
+# several worker processes aggregate their metrics through this directory
+_MULTIPROCESS_METRICS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+_tracer = None
+if TRACING_ENABLED:
+    try:
+        from opentelemetry import trace
+        _tracer = trace.get_tracer("neuraflix-mcp")
+    except ImportError:
+        print("[Tracing] opentelemetry is not installed; spans disabled")
+
+@contextmanager
+def observe_stage(stage):
+    """Time a stage into STAGE_LATENCY, count failures and open a trace span."""
+    with ExitStack() as stack:
+        if _tracer:
+            stack.enter_context(_tracer.start_as_current_span(stage))
+        start = time.perf_counter()
         try:
-            resp = await client.get(OMDB_BASE_URL, params=params)
-            resp.raise_for_status()
-            return resp.json()
-        except Exception as e:
-            print("[OMDb] Error:", e)
+            yield
+        except Exception:
+            STAGE_ERRORS.labels(stage).inc()
+            raise
+        finally:
+            STAGE_LATENCY.labels(stage).observe(time.perf_counter() - start)
+
+def traced(fn):
+    """Wrap an async tool in a trace span when tracing is enabled."""
+    if _tracer is None:
+        return fn
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        with _tracer.start_as_current_span(f"tool.{fn.__name__}"):
+            return await fn(*args, **kwargs)
+
+    return wrapper
+
+BACKEND_RETRIES = Counter("neuraflix_backend_retries_total", "Retried backend calls", ["backend", "reason"])
+BACKEND_RATE = Gauge("neuraflix_backend_rate_per_sec", "Current adaptive request rate", ["backend"])
+BREAKER_OPEN = Gauge("neuraflix_breaker_open", "1 while a backend circuit is open", ["backend"])
+
+class BackendUnavailable(Exception):
+    """Raised without calling the backend while its circuit is open."""
+
+class OmdbRateLimited(Exception):
+    """OMDb answered with its 'Request limit reached!' error."""
+
+class TokenBucket:
+    """Async token bucket whose rate halves on throttling and creeps back up on success."""
+
+    def __init__(self, name, rate, burst=None):
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        BACKEND_RATE.labels(name).set(rate)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttled(self, retry_after=None):
+        self.rate = max(self.max_rate / 20, self.rate / 2)
+        if retry_after:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        BACKEND_RATE.labels(self.name).set(self.rate)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+            BACKEND_RATE.labels(self.name).set(self.rate)
+
+class CircuitBreaker:
+    """Open after BREAKER_THRESHOLD consecutive failures; let one trial call through after the reset time."""
+
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def check(self):
+        """Raise while the circuit is open; True when this call is the half-open trial."""
+        if self.opened_at is None:
+            return False
+        if time.monotonic() - self.opened_at < BREAKER_RESET_SECS or self.trial_running:
+            raise BackendUnavailable(f"{self.name} circuit is open")
+        self.trial_running = True
+        return True
+
+    def end_trial(self):
+        # a trial that was cancelled or errored without a verdict frees the slot for the next one
+        self.trial_running = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        BREAKER_OPEN.labels(self.name).set(0)
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.failures >= BREAKER_THRESHOLD:
+            if self.opened_at is None:
+                print(f"[{self.name}] Circuit opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+            BREAKER_OPEN.labels(self.name).set(1)
+
+class BackendGuard:
+    """Rate limit, retry and circuit-break calls to one backend.
+
+    `classify(exc)` returns None for errors that must not be retried, or
+    (reason, retry_after) with reason "throttled", "unavailable" or
+    "conflict" (a race an idempotent call resolves by retrying) and the
+    server's retry-after hint in seconds (None when it sent none). Only
+    "unavailable" errors count towards opening the circuit; any other
+    answer shows the backend is up and closes it.
+    """
+
+    def __init__(self, name, rate, classify):
+        self.name = name
+        self.bucket = TokenBucket(name, rate)
+        self.breaker = CircuitBreaker(name)
+        self.classify = classify
+
+    async def call(self, fn, *args, **kwargs):
+        for attempt in range(RETRY_ATTEMPTS):
+            trial = self.breaker.check()
+            try:
+                await self.bucket.acquire()
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                verdict = self.classify(e)
+                if verdict is None:
+                    self.breaker.record_success()  # the backend answered
+                    raise
+                reason, retry_after = verdict
+                if reason == "unavailable":
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                    if reason == "throttled":
+                        self.bucket.throttled(retry_after)
+                if attempt == RETRY_ATTEMPTS - 1:
+                    raise
+            else:
+                self.breaker.record_success()
+                self.bucket.succeeded()
+                return result
+            finally:
+                if trial:
+                    self.breaker.end_trial()
+            BACKEND_RETRIES.labels(self.name, reason).inc()
+            backoff = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            await asyncio.sleep(max(backoff, retry_after or 0))
+
+def _parse_retry_after(value):
+    """Seconds from a Retry-After header, a millisecond count or a .NET timespan."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        if ":" in value:  # Cosmos x-ms-retry-after-ms, e.g. 00:00:00.0500000
+            h, m, sec = value.split(":")
+            return int(h) * 3600 + int(m) * 60 + float(sec)
+        return float(value)
+    except ValueError:
+        return None
+
+def classify_omdb_error(e):
+    if isinstance(e, OmdbRateLimited):
+        return "throttled", None
+    if isinstance(e, httpx.HTTPStatusError):
+        status = e.response.status_code
+        retry_after = _parse_retry_after(e.response.headers.get("retry-after"))
+        if status == 429 or (status == 401 and "limit" in e.response.text.lower()):
+            return "throttled", retry_after
+        if status >= 500:
+            return "unavailable", retry_after
+        return None
+    if isinstance(e, httpx.TransportError):
+        return "unavailable", None
+    return None
+
+def is_gremlin_connection_error(e):
+    """True for transport failures of the Gremlin websocket, as opposed to bugs or bad queries."""
+    import aiohttp
+
+    if isinstance(e, (OSError, TimeoutError, asyncio.TimeoutError, aiohttp.ClientError)):
+        return True
+    # gremlin_python reports dropped websockets as RuntimeError("Connection was ... closed")
+    return isinstance(e, RuntimeError) and "connection" in str(e).lower()
+
+def classify_gremlin_error(e):
+    from gremlin_python.driver.protocol import GremlinServerError
+
+    if isinstance(e, GremlinServerError):
+        attrs = getattr(e, "status_attributes", None) or {}
+        status = int(attrs.get("x-ms-status-code", 0) or 0)
+        retry_after = attrs.get("x-ms-retry-after-ms")
+        if status == 429:
+            seconds = _parse_retry_after(retry_after)
+            # a bare number here is milliseconds
+            if seconds is not None and ":" not in str(retry_after):
+                seconds /= 1000
+            return "throttled", seconds
+        if status in (408, 449, 503):
+            return "unavailable", None
+        if status == 409:
+            # concurrent upserts adding the same person; the retry finds the vertex
+            return "conflict", None
+        return None
+    if is_gremlin_connection_error(e):
+        return "unavailable", None
+    return None
+
+omdb_guard = BackendGuard("OMDb", OMDB_RATE_PER_SEC, classify_omdb_error)
+gremlin_guard = BackendGuard("Gremlin", GREMLIN_RATE_PER_SEC, classify_gremlin_error)
+
+_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="neuraflix-blocking")
+if not _MULTIPROCESS_METRICS:
+    EXECUTOR_QUEUE.set_function(lambda: _executor._work_queue.qsize())
+
+def run_blocking(fn, *args, **kwargs):
+    future = asyncio.get_running_loop().run_in_executor(_executor, lambda: fn(*args, **kwargs))
+    if _MULTIPROCESS_METRICS:
+        EXECUTOR_QUEUE.set(_executor._work_queue.qsize())
+    return future
+
+async def run_bounded(fn, items, limit):
+    """Run fn(item) for every item with at most `limit` in flight.
+
+    Results come back in input order; an exception raised for one item is
+    returned in its slot instead of cancelling the others.
+    """
+    sem = asyncio.Semaphore(max(1, limit))
+
+    async def _one(item):
+        async with sem:
+            return await fn(item)
+
+    return await asyncio.gather(*(_one(i) for i in items), return_exceptions=True)
+
+_stores = []
+
+class SqliteStore:
+    """JSON key/value table with optional expiry in a local SQLite file.
+
+    One connection per store, shared between threads behind a lock; WAL mode
+    lets several stores (and server processes on one host) use the same file.
+    """
+
+    def __init__(self, table, path=None):
+        self.table = table
+        self.path = path or os.path.join(STATE_DIR, "state.sqlite3")
+        self._lock = threading.Lock()
+        self._conn = None
+        _stores.append(self)
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, key):
+        """Return (value, expires_at) or None when missing or expired."""
+        with self._lock:
+            row = self._db().execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
             return None
-    
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            db = self._db()
+            db.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at),
+            )
+            db.commit()
+
+    def add(self, key, value, ttl=None):
+        """Set key only if it is missing or expired; True when this call set it."""
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            db = self._db()
+            db.execute(
+                f"DELETE FROM {self.table} WHERE key = ? AND expires_at IS NOT NULL AND expires_at <= ?",
+                (key, time.time()),
+            )
+            cur = db.execute(
+                f"INSERT OR IGNORE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at),
+            )
+            db.commit()
+            return cur.rowcount == 1
+
+    def delete(self, key):
+        with self._lock:
+            db = self._db()
+            db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            db.commit()
+
+    def items(self):
+        """Return every live (key, value) pair."""
+        with self._lock:
+            rows = self._db().execute(
+                f"SELECT key, value FROM {self.table} WHERE expires_at IS NULL OR expires_at > ?",
+                (time.time(),),
+            ).fetchall()
+        return [(k, json.loads(v)) for k, v in rows]
+
+    def prune(self, max_rows=None):
+        """Drop expired rows, then the oldest writes beyond max_rows."""
+        with self._lock:
+            db = self._db()
+            db.execute(f"DELETE FROM {self.table} WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+            if max_rows is not None:
+                db.execute(
+                    f"DELETE FROM {self.table} WHERE rowid NOT IN "
+                    f"(SELECT rowid FROM {self.table} ORDER BY rowid DESC LIMIT ?)",
+                    (max_rows,),
+                )
+            db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class RedisStore:
+    """Same interface as SqliteStore on a Redis server shared by all replicas.
+
+    Needs the `redis` package. Expiry is left to Redis, so prune only
+    exists for interface parity.
+    """
+
+    def __init__(self, table, url):
+        self.table = table
+        self.url = url
+        self._client = None
+        _stores.append(self)
+
+    def _redis(self):
+        if self._client is None:
+            import redis
+
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    def _key(self, key):
+        return f"neuraflix:{self.table}:{key}"
+
+    def get(self, key):
+        value, pttl = self._redis().pipeline().get(self._key(key)).pttl(self._key(key)).execute()
+        if value is None:
+            return None
+        return json.loads(value), (time.time() + pttl / 1000 if pttl > 0 else None)
+
+    def set(self, key, value, ttl=None):
+        self._redis().set(self._key(key), json.dumps(value), px=int(ttl * 1000) if ttl is not None else None)
+
+    def add(self, key, value, ttl=None):
+        px = int(ttl * 1000) if ttl is not None else None
+        return bool(self._redis().set(self._key(key), json.dumps(value), px=px, nx=True))
+
+    def delete(self, key):
+        self._redis().delete(self._key(key))
+
+    def items(self):
+        prefix = self._key("")
+        keys = list(self._redis().scan_iter(match=f"{prefix}*", count=1000))
+        if not keys:
+            return []
+        values = self._redis().mget(keys)
+        return [(k.decode()[len(prefix):], json.loads(v)) for k, v in zip(keys, values) if v is not None]
+
+    def prune(self, max_rows=None):
+        pass
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+_STORE_BACKENDS = {
+    "sqlite": lambda table, url: SqliteStore(table, url[len("sqlite:///"):] or None),
+    "redis": RedisStore,
+    "rediss": RedisStore,
+}
+
+def open_store(table):
+    """Open a key/value table on the configured state backend (SQLite by default)."""
+    if not STATE_URL:
+        return SqliteStore(table)
+    scheme = urlparse(STATE_URL).scheme
+    if scheme not in _STORE_BACKENDS:
+        raise ValueError(f"Unsupported NEURAFLIX_STATE_URL scheme: {scheme}")
+    return _STORE_BACKENDS[scheme](table, STATE_URL)
+
+@on_shutdown
+async def close_stores():
+    for store in _stores:
+        store.close()
+
+_caches = {}
+
+class TieredCache:
+    """In-process LRU with per-entry TTL backed by a persistent (possibly shared) store.
+
+    `ttl_for(value)` picks the lifetime of each entry, which is how misses
+    get a shorter TTL than hits.
+    """
+
+    def __init__(self, name, maxsize, ttl, ttl_for=None, max_rows=None):
+        self.name = name
+        self.ttl_for = ttl_for or (lambda value: ttl)
+        self.max_rows = max_rows
+        self.store = open_store(f"cache_{name}")
+        self._memory = LRUCache(maxsize=maxsize)
+        self._writes = 0
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        _caches[name] = self
+
+    async def get(self, key):
+        entry = self._memory.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > time.time():
+                self.stats["memory_hits"] += 1
+                CACHE_REQUESTS.labels(self.name, "memory_hit").inc()
+                return value
+            self._memory.pop(key, None)
+
+        entry = await run_blocking(self.store.get, key)
+        if entry is not None:
+            self.stats["disk_hits"] += 1
+            CACHE_REQUESTS.labels(self.name, "disk_hit").inc()
+            self._memory[key] = entry
+            return entry[0]
+
+        self.stats["misses"] += 1
+        CACHE_REQUESTS.labels(self.name, "miss").inc()
+        return None
+
+    async def set(self, key, value):
+        ttl = self.ttl_for(value)
+        self._memory[key] = (value, time.time() + ttl)
+        await run_blocking(self.store.set, key, value, ttl)
+        self._writes += 1
+        if self.max_rows and self._writes % 1000 == 0:
+            await run_blocking(self.store.prune, self.max_rows)
+
+def normalize_title(title):
+    return " ".join(title.casefold().split())
+
+# OMDb answers that say nothing about the title itself and must not be cached
+_OMDB_TRANSIENT_ERRORS = ("Request limit reached!", "Invalid API key!", "No API key provided.")
+
+omdb_cache = TieredCache(
+    "omdb",
+    maxsize=OMDB_CACHE_SIZE,
+    ttl=OMDB_CACHE_TTL,
+    ttl_for=lambda data: OMDB_NEGATIVE_TTL if data.get("Response") == "False" else OMDB_CACHE_TTL,
+    max_rows=OMDB_CACHE_MAX_ROWS,
+)
+
+_http_client = None
+
+def get_http_client():
+    """Return the process-wide httpx client, creating it on first use.
+
+    HTTP/2 is negotiated with hosts that offer it when the `h2` package is
+    installed; otherwise the client sticks to pooled HTTP/1.1 keep-alive.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        http2 = HTTP2_ENABLED
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                http2 = False
+        _http_client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            follow_redirects=True,
+        )
+    return _http_client
+
+@on_shutdown
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        client, _http_client = _http_client, None
+        await client.aclose()
+
+IMDB_ID_RE = re.compile(r"tt\d{5,}")
+
+# match key of a title (as asked or as returned by OMDb) -> imdbID
+title_index = open_store("title_index")
+_title_keys = None  # in-memory copy of title_index for fuzzy matching
+_title_buckets = {}  # title_numbers(key) -> match keys, so only titles with the same numbers are compared
+_ROMAN_RE = re.compile(r"(?=[ivx])x{0,3}(?:ix|iv|v?i{0,3})")
+
+def title_match_key(title):
+    """Loose form of a title: case, punctuation and a leading article ignored."""
+    key = re.sub(r"[^\w\s]", " ", title.casefold())
+    key = " ".join(key.split())
+    return key[4:] if key.startswith("the ") else key
+
+def title_numbers(key):
+    """Sequel markers of a match key: digit runs and Roman numerals up to xxxix."""
+    return tuple(re.findall(r"\d+", key)) + tuple(t for t in key.split() if _ROMAN_RE.fullmatch(t))
+
+def _remember_title_key(key, imdb_id):
+    _title_keys[key] = imdb_id
+    _title_buckets.setdefault(title_numbers(key), set()).add(key)
+
+async def _load_title_keys():
+    global _title_keys
+    if _title_keys is None:
+        items = await run_blocking(title_index.items)
+        _title_keys = {}
+        for key, imdb_id in items:
+            _remember_title_key(key, imdb_id)
+    return _title_keys
+
+def _closest_title_key(key, candidates):
+    # a ratio of at least c needs the lengths within a factor of (2 - c) / c of each other
+    spread = (2 - TITLE_FUZZY_CUTOFF) / TITLE_FUZZY_CUTOFF
+    candidates = [c for c in candidates if len(key) / spread <= len(c) <= len(key) * spread]
+    matches = difflib.get_close_matches(key, candidates, n=1, cutoff=TITLE_FUZZY_CUTOFF)
+    return matches[0] if matches else None
+
+async def resolve_title(title):
+    """Resolve a title to an IMDb id from the local index, without any network call.
+
+    Exact match keys win; otherwise the closest indexed title scoring at
+    least TITLE_FUZZY_CUTOFF is used, as long as it carries the same numbers
+    and Roman numerals (so "Toy Story 2" never resolves to "Toy Story 3",
+    nor "Rocky V" to "Rocky IV"). Returns (imdb_id, exact), or (None, False).
+    """
+    keys = await _load_title_keys()
+    key = title_match_key(title)
+    if key in keys:
+        return keys[key], True
+    # another server process may have indexed it since our snapshot was taken
+    entry = await run_blocking(title_index.get, key)
+    if entry is not None:
+        _remember_title_key(key, entry[0])
+        return entry[0], True
+    bucket = list(_title_buckets.get(title_numbers(key), ()))
+    candidate = await run_blocking(_closest_title_key, key, bucket) if bucket else None
+    return (keys[candidate], False) if candidate else (None, False)
+
+async def index_title(imdb_id, *titles):
+    keys = await _load_title_keys()
+    for title in titles:
+        key = title_match_key(title)
+        if key and keys.get(key) != imdb_id:
+            _remember_title_key(key, imdb_id)
+            await run_blocking(title_index.set, key, imdb_id)
+
+async def fetch_omdb(title, refresh=False):
+    """Fetch OMDb data for a title, or for an IMDb id such as 'tt0114709'.
+
+    Titles already seen are resolved to their IMDb id through the local
+    title index and fetched with an exact i= lookup.
+    Raises once OMDb keeps failing after retries, so callers can tell an
+    outage from a movie that does not exist.
+    """
+    title = title.strip()
+    imdb_id = title if IMDB_ID_RE.fullmatch(title) else None
+    exact = True
+    if imdb_id is None:
+        if not refresh:
+            cached = await omdb_cache.get(normalize_title(title))
+            if cached is not None:
+                return cached
+        imdb_id, exact = await resolve_title(title)
+
+    if imdb_id:
+        key, params = f"id:{imdb_id}", {"i": imdb_id, "apikey": OMDB_API_KEY}
+    else:
+        key, params = normalize_title(title), {"t": title, "apikey": OMDB_API_KEY}
+    if not refresh:
+        cached = await omdb_cache.get(key)
+        if cached is not None:
+            return cached
+
+    async def _request():
+        with observe_stage("omdb_fetch"):
+            resp = await get_http_client().get(OMDB_BASE_URL, params=params)
+            resp.raise_for_status()
+            data = resp.json()
+            if data.get("Error") == "Request limit reached!":
+                raise OmdbRateLimited(data["Error"])
+            return data
+
+    try:
+        data = await omdb_guard.call(_request)
+    except Exception as e:
+        print("[OMDb] Error:", e)
+        raise
+
+    if data.get("Error") not in _OMDB_TRANSIENT_ERRORS:
+        await omdb_cache.set(key, data)
+    if data.get("Response") == "True" and data.get("imdbID"):
+        if not key.startswith("id:"):
+            await omdb_cache.set(f"id:{data['imdbID']}", data)
+        # a fuzzy guess is never recorded under the asked title, so a wrong one cannot stick
+        await index_title(data["imdbID"], *((title, data["Title"]) if exact else (data["Title"],)))
+    return data
+
+
+_container_client = None
+
+def get_container_client():
+    """Return the process-wide async Blob container client, creating it on first use."""
+    global _container_client
+    if _container_client is None:
+        from azure.storage.blob.aio import ContainerClient
 
-async def upload_blob(local_path):
-    def _upload():
         conn = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
         container = os.getenv("AZURE_STORAGE_CONTAINER_NAME")
-        bs = BlobServiceClient.from_connection_string(conn)
-        cc = bs.get_container_client(container)
-        blob_name = f"{uuid4()}-{os.path.basename(local_path)}"
-        blob = cc.get_blob_client(blob_name)
-        with open(local_path, "rb") as f:
-            blob.upload_blob(f, overwrite=True)
-        print(f"[Blob] Uploaded {local_path} as {blob_name}")
-        return blob.url
-    return await run_blocking(_upload)
-
-async def gremlin_insert(movie_id, title, year, genre, thumb, directors, actors):
-    def _work():
-        endpoint = os.getenv("GREMLIN_ENDPOINT")
-        db = os.getenv("GREMLIN_DB_NAME")
-        graph = os.getenv("GREMLIN_COLLECTION")
-        key = os.getenv("GREMLIN_PK")
-
-        client = Client(
-            endpoint, 'g',
-            username=f"/dbs/{db}/colls/{graph}",
-            password=key,
-            message_serializer=GraphSONSerializersV2d0()
+        _container_client = ContainerClient.from_connection_string(conn, container)
+    return _container_client
+
+@on_shutdown
+async def close_container_client():
+    global _container_client
+    if _container_client is not None:
+        client, _container_client = _container_client, None
+        await client.close()
+
+class PosterDownloadError(Exception):
+    pass
+
+# digest of the source poster URL -> {"url": blob URL, "variants": {width: blob URL}}
+poster_index = open_store("poster_index")
+
+_thumbnail_pool = None
+
+def get_thumbnail_pool():
+    """Return the process pool that renders poster variants, starting it on first use.
+
+    Workers must not be forked from this process, which already runs
+    executor and Gremlin threads. With forkserver they are forked from a
+    single-threaded helper instead; that helper (or, where only spawn
+    exists, every worker) re-imports the main script as __mp_main__, which
+    rebuilds the module-level server objects but never runs the __main__
+    block, so no server is started. Under forkserver this costs one import
+    per pool, not one per worker.
+    """
+    global _thumbnail_pool
+    if _thumbnail_pool is None:
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["nfThumbnails"])
+        else:
+            context = multiprocessing.get_context("spawn")
+        _thumbnail_pool = ProcessPoolExecutor(max_workers=POSTER_VARIANT_PROCESSES or None, mp_context=context)
+    return _thumbnail_pool
+
+@on_shutdown
+async def stop_thumbnail_pool():
+    global _thumbnail_pool
+    if _thumbnail_pool is not None:
+        pool, _thumbnail_pool = _thumbnail_pool, None
+        await run_blocking(pool.shutdown)
+
+async def store_poster_variants(digest, data, original_url):
+    """Render the POSTER_VARIANTS widths off the event loop and upload them next to the original.
+
+    Returns {width: blob URL} with widths as strings, ready for JSON.
+    Widths the poster is too small for point at the original.
+    """
+    from azure.storage.blob import ContentSettings
+    from nfThumbnails import render_variants
+
+    with observe_stage("poster_resize"):
+        rendered = await asyncio.get_running_loop().run_in_executor(
+            get_thumbnail_pool(), render_variants, data, POSTER_VARIANTS, POSTER_VARIANT_QUALITY
         )
+
+    async def put(variant):
+        width, body = variant
+        blob = get_container_client().get_blob_client(f"posters/{digest}_w{width}.webp")
+        with observe_stage("blob_upload"):
+            await blob.upload_blob(
+                body, length=len(body), overwrite=True,
+                content_settings=ContentSettings(content_type="image/webp"),
+            )
+        return str(width), blob.url
+
+    variants = {str(w): original_url for w in POSTER_VARIANTS}
+    variants.update(await asyncio.gather(*map(put, rendered)))
+    return variants
+
+def poster_blob_name(poster_url):
+    """Stable blob name for a poster, derived from a hash of its source URL."""
+    digest = hashlib.sha256(poster_url.encode("utf-8")).hexdigest()
+    ext = os.path.splitext(urlparse(poster_url).path)[1] or ".jpg"
+    return f"posters/{digest}{ext}", digest
+
+async def download_poster(poster_url):
+    client = get_http_client()
+    try:
+        with observe_stage("poster_download"):
+            r = await client.get(poster_url)
+            r.raise_for_status()
+    except httpx.HTTPError as e:
+        raise PosterDownloadError(e) from e
+    return r.content
+
+async def upload_poster(poster_url):
+    """Store a poster in Blob Storage once and return its index record.
+
+    The record is {"url": blob URL}, plus {"variants": {width: blob URL}}
+    when POSTER_VARIANTS is set. Blobs are named after the source URL, so
+    a poster already in the index (or found by an existence check) is
+    neither downloaded nor uploaded again. New posters are streamed chunk
+    by chunk from the CDN into the upload without touching local disk,
+    unless variants need the whole image anyway.
+    """
+    blob_name, digest = poster_blob_name(poster_url)
+    known = await run_blocking(poster_index.get, digest)
+    data = None
+    if known is not None:
+        record = known[0]
+    else:
+        url, data = await _upload_original(poster_url, blob_name)
+        record = {"url": url}
+
+    missing = [w for w in POSTER_VARIANTS if str(w) not in record.get("variants", {})]
+    if missing:
         try:
-            # movie
-            print(f"[Gremlin] Upserting movie {movie_id}")
-            client.submit(f"""
-              g.V().has('movie','id','{movie_id}').fold().coalesce(
-                unfold(),
-                addV('movie')
-                  .property('id','{movie_id}')
-                  .property('title','{title}')
-                  .property('genre','{genre}')
-                  .property('year','{year}')
-                  .property('thumbnail','{thumb}')
-              )""").all().result()
-
-            # directors
-            for d in directors:
-                d_id = d.replace(" ", "_")
-                print(f"[Gremlin] Upserting director {d_id}")
-                client.submit(f"""
-                  g.V().has('director','id','{d_id}').fold().coalesce(
-                    unfold(),
-                    addV('director')
-                      .property('id','{d_id}')
-                      .property('name','{d}')
-                      .property('genre','{genre}')
-                  )""").all().result()
-
-                print(f"[Gremlin] Linking director {d_id} -> movie {movie_id}")
-                client.submit(f"""
-                  g.V().has('director','id','{d_id}')
-                   .addE('Directed')
-                   .to(g.V().has('movie','id','{movie_id}'))
-                """).all().result()
-
-            # actors
-            for a in actors:
-                a_id = a.replace(" ", "_")
-                print(f"[Gremlin] Upserting actor {a_id}")
-                client.submit(f"""
-                  g.V().has('actor','id','{a_id}').fold().coalesce(
-                    unfold(),
-                    addV('actor')
-                      .property('id','{a_id}')
-                      .property('name','{a}')
-                      .property('genre','{genre}')
-                  )""").all().result()
-
-                print(f"[Gremlin] Linking movie {movie_id} -> actor {a_id}")
-                client.submit(f"""
-                  g.V().has('movie','id','{movie_id}').as('m')
-                   .V().has('actor','id','{a_id}')
-                   .addE('ActedIn').from('m')
-                """).all().result()
+            if data is None:
+                data = await download_poster(poster_url)
+            record["variants"] = await store_poster_variants(digest, data, record["url"])
+        except Exception as e:
+            # variants are an optimisation; the original poster is still usable
+            print(f"[Blob] Poster variants for {poster_url} failed:", e)
+    if known is None or missing:
+        await run_blocking(poster_index.set, digest, record)
+    return record
+
+async def _upload_original(poster_url, blob_name):
+    """Upload the poster itself; returns (blob URL, bytes if they were buffered)."""
+    from azure.storage.blob import ContentSettings
+
+    blob = get_container_client().get_blob_client(blob_name)
+    with observe_stage("blob_exists"):
+        exists = await blob.exists()
+    if exists:
+        print(f"[Blob] {blob_name} already stored")
+        return blob.url, None
+
+    if POSTER_VARIANTS:
+        # the variants need the whole image, so upload it from memory
+        data = await download_poster(poster_url)
+        with observe_stage("blob_upload"):
+            await blob.upload_blob(
+                data, length=len(data), overwrite=True,
+                content_settings=ContentSettings(content_type="image/jpeg"),
+            )
+        print(f"[Blob] Uploaded {poster_url} as {blob_name}")
+        return blob.url, data
+
+    client = get_http_client()
+    try:
+        # download = time to response headers; the body is timed with the upload it feeds
+        with observe_stage("poster_download"):
+            r = await client.send(client.build_request("GET", poster_url), stream=True)
+    except httpx.HTTPError as e:
+        raise PosterDownloadError(e) from e
+    try:
+        # inside the try, so an error status still hands the connection back to the pool
+        r.raise_for_status()
+        length = r.headers.get("content-length")
+        content_type = r.headers.get("content-type", "image/jpeg")
+        with observe_stage("blob_upload"):
+            await blob.upload_blob(
+                r.aiter_bytes(POSTER_CHUNK_SIZE),
+                length=int(length) if length else None,
+                overwrite=True,
+                content_settings=ContentSettings(content_type=content_type),
+            )
+    except httpx.HTTPError as e:
+        raise PosterDownloadError(e) from e
+    finally:
+        await r.aclose()
+    print(f"[Blob] Uploaded {poster_url} as {blob_name}")
+    return blob.url, None
+
+_gremlin_client = None
+_gremlin_last_ok = 0.0
+_gremlin_lock = threading.Lock()
+
+def _connect_gremlin():
+    from gremlin_python.driver.client import Client
+    from gremlin_python.driver.serializer import GraphSONSerializersV2d0
+
+    endpoint = os.getenv("GREMLIN_ENDPOINT")
+    db = os.getenv("GREMLIN_DB_NAME")
+    graph = os.getenv("GREMLIN_COLLECTION")
+    key = os.getenv("GREMLIN_PK")
+
+    print(f"[Gremlin] Opening client pool ({GREMLIN_POOL_SIZE} connections)")
+    return Client(
+        endpoint, 'g',
+        username=f"/dbs/{db}/colls/{graph}",
+        password=key,
+        message_serializer=GraphSONSerializersV2d0(),
+        pool_size=GREMLIN_POOL_SIZE,
+    )
+
+def _close_gremlin(client):
+    try:
+        client.close()
+    except Exception as e:
+        print("[Gremlin] Error closing client:", e)
+
+def get_gremlin_client():
+    """Return the process-wide Gremlin client, creating it on first use.
+
+    A pool left idle past GREMLIN_HEALTHCHECK_SECS is probed before being
+    handed out and replaced if the probe fails.
+    """
+    global _gremlin_client, _gremlin_last_ok
+    with _gremlin_lock:
+        if _gremlin_client is not None and time.monotonic() - _gremlin_last_ok > GREMLIN_HEALTHCHECK_SECS:
+            try:
+                _gremlin_client.submit("g.inject(1)").all().result()
+                _gremlin_last_ok = time.monotonic()
+            except Exception as e:
+                print("[Gremlin] Health check failed, reconnecting:", e)
+                _close_gremlin(_gremlin_client)
+                _gremlin_client = None
+        if _gremlin_client is None:
+            _gremlin_client = _connect_gremlin()
+            _gremlin_last_ok = time.monotonic()
+        return _gremlin_client
 
+def reset_gremlin_client(client=None):
+    """Drop the shared client (only if it is still `client`, when given)."""
+    global _gremlin_client
+    with _gremlin_lock:
+        if _gremlin_client is None or (client is not None and _gremlin_client is not client):
+            return
+        stale, _gremlin_client = _gremlin_client, None
+    _close_gremlin(stale)
+
+def gremlin_submit(query, bindings=None):
+    """Submit a traversal on the shared pool, reconnecting once on connection errors."""
+    global _gremlin_last_ok
+    from gremlin_python.driver.protocol import GremlinServerError
+
+    for attempt in range(2):
+        client = get_gremlin_client()
+        try:
+            result = client.submit(query, bindings).all().result()
+            _gremlin_last_ok = time.monotonic()
+            return result
+        except GremlinServerError:
+            # the server answered, so the connection itself is fine
+            raise
+        except Exception as e:
+            if attempt or not is_gremlin_connection_error(e):
+                raise
+            print("[Gremlin] Connection error, reconnecting:", e)
+            reset_gremlin_client(client)
+
+async def gremlin_call(stage, query, bindings=None):
+    """Submit a traversal from async code through the Gremlin guard, timing each attempt."""
+    async def _attempt():
+        with observe_stage(stage):
+            return await run_blocking(gremlin_submit, query, bindings)
+
+    return await gremlin_guard.call(_attempt)
+
+@on_shutdown
+async def close_gremlin_client():
+    await run_blocking(reset_gremlin_client)
+
+def person_id(name):
+    return name.replace(" ", "_")
+
+class KnownVertices:
+    """Bounded LRU set of (label, id) pairs confirmed to exist in the graph.
+
+    Only touched from the event loop; entries are evicted when a write shows
+    the vertex is gone.
+    """
+
+    def __init__(self, maxsize):
+        self._keys = LRUCache(maxsize=maxsize)
+        self.stats = {"hits": 0, "misses": 0}
+        _caches["known_vertices"] = self
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        if self._keys.get(key):
+            self.stats["hits"] += 1
+            CACHE_REQUESTS.labels("known_vertices", "hit").inc()
+            return True
+        self.stats["misses"] += 1
+        CACHE_REQUESTS.labels("known_vertices", "miss").inc()
+        return False
+
+    def add(self, keys):
+        for key in keys:
+            self._keys[key] = True
+
+    def discard(self, keys):
+        for key in keys:
+            self._keys.pop(key, None)
+
+known_vertices = KnownVertices(KNOWN_VERTEX_CACHE_SIZE)
+
+async def warm_known_vertices():
+    """Preload the known-vertex cache with existing directors and actors."""
+    try:
+        rows = await gremlin_call(
+            "gremlin_warm",
+            "g.V().hasLabel('director','actor').limit(n).project('label','id').by(label).by(id)",
+            {"n": KNOWN_VERTEX_CACHE_SIZE},
+        )
+    except Exception as e:
+        print("[Gremlin] Known-vertex warm-up failed:", e)
+        return
+    known_vertices.add((r["label"], r["id"]) for r in rows)
+    print(f"[Gremlin] Warmed known-vertex cache with {len(rows)} people")
+
+_warmup_task = None  # held so the loop cannot garbage-collect it mid-flight
+
+def start_known_vertex_warmup():
+    global _warmup_task
+    if _warmup_task is None or _warmup_task.done():
+        _warmup_task = asyncio.create_task(warm_known_vertices())
+
+@on_shutdown
+async def stop_known_vertex_warmup():
+    global _warmup_task
+    if _warmup_task is not None:
+        task, _warmup_task = _warmup_task, None
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+def movie_fingerprint(data, variant_widths=()):
+    """Digest of the OMDb fields we store, used to detect unchanged movies.
+
+    `variant_widths` are the poster variants stored with the movie, so a
+    movie missing some of the configured ones is written again.
+    """
+    fields = [data.get(k, "") for k in ("imdbID", "Title", "Year", "Genre", "Poster", "Director", "Actors")]
+    if variant_widths:
+        fields.append(sorted(int(w) for w in variant_widths))
+    return hashlib.sha1(json.dumps(fields).encode("utf-8")).hexdigest()
+
+def legacy_movie_id(title):
+    """Id movie vertices had before they were keyed on imdbID."""
+    return title.replace(" ", "_")
+
+def build_movie_upsert(movie_id, title, year, genre, thumb, directors, actors, fingerprint, known=(),
+                       variants=None, legacy_id=None):
+    """Build one traversal upserting a movie, its people and their edges.
+
+    Every value travels as a binding, so the script text only depends on
+    the number of directors and actors (and the variant widths) and stays
+    cacheable server-side. Movie properties are (re)written on every run;
+    edges are only added when missing, so re-inserting a movie never
+    duplicates them. People whose (label, id) is in `known` are looked up
+    instead of upserted. `variants` maps poster widths to URLs stored as
+    `thumbnail_w<width>`. A title-keyed vertex left from before imdbID
+    keys (`legacy_id`) is dropped in the same traversal; its edges are
+    rebuilt on the new vertex. Returns (script, bindings).
+    """
+    bindings = {
+        "mid": movie_id,
+        "title": title,
+        "genre": genre,
+        "year": year,
+        "thumb": thumb,
+        "fp": fingerprint,
+    }
+    migrate = ""
+    if legacy_id and legacy_id != movie_id:
+        bindings["lid"] = legacy_id
+        migrate = ".sideEffect(V().has('movie','id',lid).drop())"
+    steps = [f"""g.V().has('movie','id',mid).fold(){migrate}.coalesce(
+        unfold(),
+        addV('movie').property('id',mid)
+      )
+      .property('title',title)
+      .property('genre',genre)
+      .property('year',year)
+      .property('thumbnail',thumb)
+      .property('fingerprint',fp)"""]
+    for width, url in sorted((variants or {}).items(), key=lambda v: int(v[0])):
+        bindings[f"thumb_w{width}"] = url
+        steps.append(f"""
+      .property('thumbnail_w{width}',thumb_w{width})""")
+    steps.append("""
+      .as('m')""")
+
+    for i, d in enumerate(directors):
+        bindings[f"d{i}_id"] = person_id(d)
+        if ("director", person_id(d)) in known:
+            steps.append(f"""
+      .V().has('director','id',d{i}_id)""")
+        else:
+            bindings[f"d{i}_name"] = d
+            steps.append(f"""
+      .coalesce(
+        V().has('director','id',d{i}_id),
+        addV('director').property('id',d{i}_id).property('name',d{i}_name).property('genre',genre)
+      )""")
+        steps.append("""
+      .coalesce(
+        outE('Directed').where(inV().has('id',mid)),
+        addE('Directed').to('m')
+      )""")
+
+    for i, a in enumerate(actors):
+        bindings[f"a{i}_id"] = person_id(a)
+        if ("actor", person_id(a)) in known:
+            steps.append(f"""
+      .V().has('actor','id',a{i}_id)""")
+        else:
+            bindings[f"a{i}_name"] = a
+            steps.append(f"""
+      .coalesce(
+        V().has('actor','id',a{i}_id),
+        addV('actor').property('id',a{i}_id).property('name',a{i}_name).property('genre',genre)
+      )""")
+        steps.append("""
+      .coalesce(
+        inE('ActedIn').where(outV().has('id',mid)),
+        addE('ActedIn').from('m')
+      )""")
+
+    return "".join(steps), bindings
+
+async def gremlin_movie_fingerprint(movie_id):
+    """Fingerprint stored on an existing movie vertex, or None."""
+    values = await gremlin_call(
+        "gremlin_fingerprint", "g.V(mid).hasLabel('movie').values('fingerprint')", {"mid": movie_id}
+    )
+    return values[0] if values else None
+
+async def gremlin_insert(movie_id, title, year, genre, thumb, directors, actors, fingerprint, variants=None,
+                         legacy_id=None):
+    people = [("director", person_id(d)) for d in directors] + [("actor", person_id(a)) for a in actors]
+    known = {p for p in people if p in known_vertices}
+
+    print(f"[Gremlin] Upserting movie {movie_id} with "
+          f"{len(directors)} director(s) and {len(actors)} actor(s), {len(known)} already known")
+    while True:
+        script, bindings = build_movie_upsert(
+            movie_id, title, year, genre, thumb, directors, actors, fingerprint, known, variants, legacy_id
+        )
+        try:
+            # the upsert is idempotent, so the guard may safely retry it
+            result = await gremlin_call("gremlin_upsert", script, bindings)
         except Exception:
             print("[Gremlin] Error during insert:")
             traceback.print_exc()
-        finally:
-            client.close()
+            raise
+        if result or not known:
+            break
+        # a vertex we believed in is gone and the traversal came back empty
+        print(f"[Gremlin] Known vertices missing for {movie_id}, retrying with full upserts")
+        known_vertices.discard(known)
+        known = set()
+
+    known_vertices.add(people)
+
+
+_llm = None
+_title_extractor = None
+
+class MovieTitles(BaseModel):
+    """Movie titles referred to by a user prompt."""
+    titles: list[str] = Field(description="Official titles of real movies, one entry per movie, no numbering")
+
+def get_llm():
+    """Return the shared Groq chat model, importing LangChain on first use."""
+    global _llm
+    if _llm is None:
+        from langchain_groq import ChatGroq
+
+        # Ensure GROQ_API_KEY is loaded
+        if not os.getenv("GROQ_API_KEY"):
+            load_dotenv()
+            os.environ["GROQ_API_KEY"] = os.getenv("GROQ_API_KEY")
+        # keep qwen's <think> output out of the answer
+        _llm = ChatGroq(model="qwen/qwen3-32b", reasoning_format="hidden")
+    return _llm
 
-    await run_blocking(_work)
+def get_title_extractor():
+    """Return the shared LLM runnable that answers with a MovieTitles object."""
+    global _title_extractor
+    if _title_extractor is None:
+        _title_extractor = get_llm().with_structured_output(MovieTitles)
+    return _title_extractor
 
+title_cache = TieredCache("titles", maxsize=TITLE_CACHE_SIZE, ttl=TITLE_CACHE_TTL, max_rows=TITLE_CACHE_MAX_ROWS)
 
-from langchain_groq import ChatGroq
-from langchain_core.prompts import ChatPromptTemplate
+async def notify_progress(ctx, done, total, message):
+    """Send a per-title result to the calling client as soon as it is known.
+
+    The result goes out as a log message (shown by any MCP client) and as a
+    progress notification when the client asked for progress.
+    """
+    if ctx is None:
+        return
+    try:
+        await ctx.info(message)
+        await ctx.report_progress(done, total, message)
+    except Exception as e:
+        print("[MCP] Progress notification failed:", e)
+
+_LIST_MARKER_RE = re.compile(r"^\s*(?:\d+\s*[.)]|[-*•])\s+")
+
+def parse_title_list(content):
+    """Titles from a free-text numbered or bulleted list.
+
+    Only a leading list marker is stripped, so titles such as
+    "Mr. & Mrs. Smith" survive; <think> blocks are dropped.
+    """
+    content = re.sub(r"<think>.*?</think>", "", content, flags=re.DOTALL)
+    titles = []
+    for line in content.splitlines():
+        title = _LIST_MARKER_RE.sub("", line).strip().strip('"*').strip()
+        if title:
+            titles.append(title)
+    return titles
+
+async def extract_titles(user_prompt):
+    """Ask the LLM for the list of real movie titles a prompt refers to.
+
+    Answers are memoized per normalized prompt, so a repeated or trivially
+    reworded prompt skips the LLM round-trip.
+    """
+    from langchain_core.prompts import ChatPromptTemplate
+
+    key = title_match_key(user_prompt)
+    cached = await title_cache.get(key)
+    if cached is not None:
+        return cached
+
+    # Prompt to extract movie titles
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", "You're an assistant that extracts real, valid movie titles from a user prompt. "
+                   "Return the official title of every movie the prompt refers to, one per line, without extra commentary."),
+        ("user", "{prompt}")
+    ])
+    messages = prompt.format_messages(prompt=user_prompt)
+
+    try:
+        answer = await get_title_extractor().ainvoke(messages)
+        titles = [t.strip() for t in answer.titles if t.strip()]
+    except Exception as e:
+        # models occasionally miss the tool call; fall back to a plain list
+        print("[LLM] Structured title extraction failed, parsing text instead:", e)
+        response = await get_llm().ainvoke(messages)
+        titles = parse_title_list(response.content)
+
+    titles = list(dict.fromkeys(titles))
+    if titles:
+        await title_cache.set(key, titles)
+    return titles
 
 @mcp.tool()
-async def insert_movies_from_prompt(user_prompt: str) -> str:
+@traced
+async def insert_movies_from_prompt(
+    user_prompt: str, force: bool = False, background: bool = False, ctx: Context = None
+) -> str:
     """
     Accepts a user prompt (e.g., 'Insert Harry Potter movie series'),
     uses the LLM to extract or generate a list of real movie titles,
     and inserts them into the NeuraFlix knowledge graph.
+
+    Movies already in the graph with unchanged metadata are skipped unless
+    `force` is true. Each title's result is streamed to the client as it
+    completes. With `background=True` the work is queued as an ingest job
+    and its id is returned immediately; follow it with get_ingest_job_status.
     """
-    # Ensure GROQ_API_KEY is loaded
-    if not os.getenv("GROQ_API_KEY"):
-        load_dotenv()
-        os.environ["GROQ_API_KEY"] = os.getenv("GROQ_API_KEY")
-
-    try:
-        # Prompt to extract movie titles
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", "You're an assistant that extracts real, valid movie titles from a user prompt. "
-                       "Return a numbered list of actual movie titles only, without extra commentary."),
-            ("user", "{prompt}")
-        ])
-        messages = prompt.format_messages(prompt=user_prompt)
-
-        llm = ChatGroq(model="qwen/qwen3-32b")
-        response = await llm.ainvoke(messages)
-        content = response.content.strip()
-
-        # Parse the LLM's response into movie title list
-        lines = content.splitlines()
-        titles = []
-        for line in lines:
-            # Extract titles from numbered list like "1. Harry Potter and the Sorcerer's Stone"
-            if "." in line:
-                title = line.split(".", 1)[1].strip().strip('"')
-                if title:
-                    titles.append(title)
-            else:
-                # fallback for unnumbered plain lines
-                cleaned = line.strip().strip('"')
-                if cleaned:
-                    titles.append(cleaned)
+    if background:
+        job_id = await enqueue_ingest_job("prompt", user_prompt, force)
+        return f"Queued ingest job {job_id}. Use get_ingest_job_status to follow it."
 
+    try:
+        titles = await extract_titles(user_prompt)
         if not titles:
             return "No valid movie titles were extracted from the prompt."
 
-        result_msgs = []
-        for title in titles:
-            result = await insert_movie_with_details(title)
-            result_msgs.append(f"✔️ {title}: {result}")
+        done = 0
+        await notify_progress(ctx, 0, len(titles), f"Inserting {len(titles)} movie(s): {', '.join(titles)}")
+
+        async def insert_one(title):
+            nonlocal done
+            try:
+                outcome = await insert_movie_with_details(title, force=force)
+                result = f"{'✔️' if insert_succeeded(outcome) else '❌'} {title}: {outcome}"
+            except Exception as e:
+                result = f"❌ {title}: {e}"
+            done += 1
+            await notify_progress(ctx, done, len(titles), result)
+            return result
 
+        result_msgs = await run_bounded(insert_one, titles, INGEST_CONCURRENCY)
         return "\n".join(result_msgs)
 
     except Exception as e:
         return f"[Error] Could not process movies from prompt: {e}"
 
+async def prepare_movie(title, force=False):
+    """Metadata stage: resolve a title (or IMDb id) into a movie record.
+
+    Returns (movie, None) when the movie should be written, or
+    (None, message) when there is nothing more to do for it.
+    """
+    data = await fetch_omdb(title, refresh=force)
+    if not data or data.get("Response")=="False":
+        return None, f"Movie not found: {title}"
+
+    at = data["Title"]
+    movie = {
+        "id": data.get("imdbID") or legacy_movie_id(at),
+        "title": at,
+        "year": data.get("Year","Unknown"),
+        "genre": data.get("Genre","Unknown"),
+        "poster": data.get("Poster"),
+        "directors": [d.strip() for d in data.get("Director","").split(",") if d.strip() and d.strip() != "N/A"],
+        "actors": [a.strip() for a in data.get("Actors","").split(",") if a.strip() and a.strip() != "N/A"],
+        "omdb": data,
+        "fingerprint": movie_fingerprint(data, POSTER_VARIANTS),
+    }
+
+    if not force:
+        try:
+            if await gremlin_movie_fingerprint(movie["id"]) == movie["fingerprint"]:
+                return None, f"Already ingested: {at}"
+        except BackendUnavailable:
+            raise
+        except Exception as e:
+            print("[Gremlin] Existence check failed:", e)
+
+    return movie, None
+
+async def transfer_poster(movie):
+    """Poster stage: copy the poster (and its variants) to Blob Storage and record the URLs on the movie."""
+    poster = await upload_poster(movie["poster"])
+    movie["thumb"], movie["variants"] = poster["url"], poster.get("variants", {})
+    # describe what was actually stored, so variants that failed are retried next time
+    movie["fingerprint"] = movie_fingerprint(movie["omdb"], movie["variants"].keys() & set(map(str, POSTER_VARIANTS)))
+    return movie
+
+async def write_movie(movie):
+    """Graph stage: upsert the movie, its people and edges."""
+    await gremlin_insert(
+        movie["id"], movie["title"], movie["year"], movie["genre"], movie["thumb"],
+        movie["directors"], movie["actors"], movie["fingerprint"], movie.get("variants"),
+        legacy_movie_id(movie["title"]),
+    )
+    return f"Inserted: {movie['title']}"
+
+# insert_movie_with_details reports these failures in its return value instead of raising
+_INSERT_FAILURES = ("[Error]", "Metadata fetched", "Movie not found")
+
+def insert_succeeded(result):
+    return not result.startswith(_INSERT_FAILURES)
+
 @mcp.tool()
-async def insert_movie_with_details(title: str) -> str:
+@traced
+async def insert_movie_with_details(title: str, force: bool = False) -> str:
     """
     Insert a movie and its metadata into the NeuraFlix knowledge graph.
 
     This tool fetches movie details from the OMDb API using the given title,
     downloads and uploads the poster image to Azure Blob Storage, and inserts
     the movie, its directors, and actors into the Cosmos DB Gremlin graph database.
+    A movie already in the graph with the same metadata is left untouched;
+    pass `force=True` to re-fetch and rewrite it.
     """
-    data = await fetch_omdb(title)
-    if not data or data.get("Response")=="False":
-        return f"Movie not found: {title}"
-
-    at = data["Title"]
-    year = data.get("Year","Unknown")
-    genre = data.get("Genre","Unknown")
-    poster = data.get("Poster")
-    directors = [d.strip() for d in data.get("Director","").split(",") if d.strip() and d.strip() != "N/A"]
-    actors = [a.strip() for a in data.get("Actors","").split(",") if a.strip() and a.strip() != "N/A"]
-
-    # poster download
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".jpg")
     try:
-        async with httpx.AsyncClient(timeout=15) as c:
-            r = await c.get(poster)
-            r.raise_for_status()
-            tmp.write(r.content)
+        movie, message = await prepare_movie(title, force)
     except Exception as e:
+        return f"[Error] Metadata lookup failed for {title}: {e}"
+    if movie is None:
+        return message
+
+    # poster download + upload
+    try:
+        await transfer_poster(movie)
+    except PosterDownloadError as e:
         print("[Poster] Download failed:", e)
-        tmp.close()
         return "Metadata fetched; poster download failed."
-    tmp.close()
-
-    # upload
-    thumb_url = await upload_blob(tmp.name)
-    os.remove(tmp.name)
-    if not thumb_url:
+    except Exception as e:
+        print("[Blob] Upload failed:", e)
         return "Metadata fetched; poster upload failed."
 
-    movie_id = at.replace(" ","_")
-    await gremlin_insert(movie_id, at, year, genre, thumb_url, directors, actors)
+    try:
+        return await write_movie(movie)
+    except Exception as e:
+        return f"Metadata fetched, poster stored; graph write failed: {e}"
+
+def read_title_file(path):
+    """Yield titles or IMDb ids from a CSV, JSONL or plain text file.
+
+    CSV files may carry an imdbID/imdb_id/title column (otherwise the first
+    column is used); JSONL lines are strings or objects with one of those keys.
+    """
+    keys = ("imdbID", "imdb_id", "title", "Title")
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                if isinstance(item, dict):
+                    item = next((item[k] for k in keys if item.get(k)), None)
+                if item:
+                    yield str(item).strip()
+        elif path.endswith(".csv"):
+            rows = csv.reader(f)
+            header = next(rows, None)
+            if header is None:
+                return
+            col = next((header.index(k) for k in keys if k in header), None)
+            if col is None:
+                col = 0
+                if header and header[0].strip():
+                    yield header[0].strip()
+            for row in rows:
+                if len(row) > col and row[col].strip():
+                    yield row[col].strip()
+        else:
+            for line in f:
+                if line.strip():
+                    yield line.strip()
+
+class IngestCheckpoint:
+    """Append-only JSONL log of finished entries, so a bulk run can resume."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line)["key"])
+                    except (ValueError, KeyError):
+                        pass  # torn last line after a crash
+        self._file = open(path, "a", encoding="utf-8")
+
+    def record(self, key, result):
+        self._file.write(json.dumps({"key": key, "result": result}) + "\n")
+        self._file.flush()
+        self.done.add(key)
+
+    def close(self):
+        self._file.close()
+
+_STAGE_DONE = object()
+
+async def _run_stage(fn, inbox, outbox, workers, downstream_workers, finish):
+    """Feed items from inbox through fn with `workers` tasks.
+
+    fn returns the payload for the next stage, or a result string when the
+    entry is finished; exceptions finish the entry as failed.
+    """
+    async def worker():
+        while True:
+            item = await inbox.get()
+            if item is _STAGE_DONE:
+                return
+            key, payload = item
+            try:
+                out = await fn(payload)
+            except Exception as e:
+                await finish(key, f"[Error] {e}", False)
+                continue
+            if isinstance(out, str):
+                await finish(key, out, True)
+            else:
+                await outbox.put((key, out))
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    if outbox is not None:
+        for _ in range(downstream_workers):
+            await outbox.put(_STAGE_DONE)
+
+async def bulk_ingest(path, checkpoint_path=None, force=False, on_result=None):
+    """Ingest every title/IMDb id in a file through a staged pipeline.
+
+    Metadata fetch, poster transfer and graph write each run with their own
+    worker count (BULK_*_WORKERS) and bounded queues in between, so a slow
+    stage holds back the ones before it instead of piling up memory.
+    Finished entries are appended to the checkpoint file and skipped when
+    the same file is ingested again; failed ones are retried.
+    `on_result(key, result, ok)` may be a plain function or a coroutine.
+    """
+    # fail on a missing/unreadable input before creating a checkpoint next to it
+    with open(path, encoding="utf-8"):
+        pass
+    checkpoint = IngestCheckpoint(checkpoint_path or f"{path}.checkpoint.jsonl")
+    stats = {"inserted": 0, "skipped": 0, "failed": 0, "resumed": 0}
+
+    async def finish(key, result, ok):
+        if ok:
+            checkpoint.record(key, result)
+            stats["skipped" if result.startswith(("Already ingested", "Movie not found")) else "inserted"] += 1
+        else:
+            stats["failed"] += 1
+        if on_result:
+            reported = on_result(key, result, ok)
+            if inspect.isawaitable(reported):
+                await reported
+
+    async def fetch(entry):
+        movie, message = await prepare_movie(entry, force)
+        return message if movie is None else movie
+
+    fetch_q = asyncio.Queue(BULK_QUEUE_SIZE)
+    poster_q = asyncio.Queue(BULK_QUEUE_SIZE)
+    graph_q = asyncio.Queue(BULK_QUEUE_SIZE)
+
+    async def produce():
+        seen = set()
+        for entry in read_title_file(path):
+            if entry in seen:
+                continue
+            seen.add(entry)
+            if entry in checkpoint.done:
+                stats["resumed"] += 1
+                continue
+            await fetch_q.put((entry, entry))
+        for _ in range(BULK_FETCH_WORKERS):
+            await fetch_q.put(_STAGE_DONE)
+
+    tasks = [
+        asyncio.create_task(produce()),
+        asyncio.create_task(_run_stage(fetch, fetch_q, poster_q, BULK_FETCH_WORKERS, BULK_POSTER_WORKERS, finish)),
+        asyncio.create_task(_run_stage(transfer_poster, poster_q, graph_q, BULK_POSTER_WORKERS, BULK_GRAPH_WORKERS, finish)),
+        asyncio.create_task(_run_stage(write_movie, graph_q, None, BULK_GRAPH_WORKERS, 0, finish)),
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        checkpoint.close()
+    return stats
+
+def resolve_ingest_path(path):
+    """Resolve a client-supplied path inside BULK_INGEST_DIR; ValueError if it points elsewhere."""
+    root = os.path.realpath(BULK_INGEST_DIR)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root or resolved == root:
+        raise ValueError(f"{path} is not a file in the ingest directory")
+    return resolved
+
+@mcp.tool()
+@traced
+async def bulk_ingest_movies(
+    path: str, force: bool = False, background: bool = False, ctx: Context = None
+) -> str:
+    """
+    Bulk-insert every movie listed in a CSV, JSONL or text file on the server.
+
+    `path` is relative to the server's ingest directory (BULK_INGEST_DIR).
+    Entries are movie titles or IMDb ids. Each entry's result is streamed
+    to the client as it finishes. Progress is checkpointed next to the
+    file, so calling the tool again on the same file resumes the run.
+    With `background=True` the run is queued as an ingest job and its id
+    is returned immediately.
+    """
+    try:
+        path = resolve_ingest_path(path)
+    except ValueError as e:
+        return f"[Error] {e}"
+    if background:
+        job_id = await enqueue_ingest_job("file", path, force)
+        return f"Queued ingest job {job_id}. Use get_ingest_job_status to follow it."
+
+    done = 0
+
+    async def report(key, result, ok):
+        nonlocal done
+        done += 1
+        await notify_progress(ctx, done, None, f"{'✔️' if ok else '❌'} {key}: {result}")
+
+    try:
+        stats = await bulk_ingest(path, force=force, on_result=report)
+    except Exception as e:
+        return f"[Error] Bulk ingest of {path} failed: {e}"
+    return (f"Bulk ingest of {path}: {stats['inserted']} inserted, {stats['skipped']} skipped, "
+            f"{stats['failed']} failed, {stats['resumed']} already done in a previous run")
+
+# job id -> job record; finished jobs expire after JOB_RETENTION_SECS
+ingest_jobs = open_store("ingest_jobs")
+_JOB_FINISHED = ("done", "failed", "cancelled")
+_job_queue = None
+_queued_jobs = set()  # ids waiting in _job_queue, so the sweeper never queues one twice
+_job_workers = []
+_running_jobs = {}  # job id -> (job, task) for jobs running in this process
+# job id -> owning process, so replicas sharing the job store never run a job twice
+job_leases = open_store("ingest_job_leases")
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+async def save_job(job):
+    job["updated"] = time.time()
+    if job["status"] == "running":
+        stored = await run_blocking(ingest_jobs.get, job["id"])
+        if stored is not None and stored[0]["status"] == "cancelled":
+            # cancelled through another server process
+            job["status"] = "cancelled"
+            if job["id"] in _running_jobs:
+                _running_jobs[job["id"]][1].cancel()
+        else:
+            await run_blocking(job_leases.set, job["id"], WORKER_ID, JOB_LEASE_SECS)
+    ttl = JOB_RETENTION_SECS if job["status"] in _JOB_FINISHED else None
+    # snapshot on the loop thread; titles keep completing while the write runs
+    await run_blocking(ingest_jobs.set, job["id"], copy.deepcopy(job), ttl)
+
+def queue_job(job_id):
+    if job_id not in _queued_jobs:
+        _queued_jobs.add(job_id)
+        _job_queue.put_nowait(job_id)
+
+async def requeue_unfinished_jobs():
+    """Queue jobs that are unfinished and not leased by a live server process."""
+    for job_id, job in await run_blocking(ingest_jobs.items):
+        if job["status"] in _JOB_FINISHED or job_id in _running_jobs or job_id in _queued_jobs:
+            continue
+        if job["status"] == "running" and await run_blocking(job_leases.get, job_id) is not None:
+            continue
+        print(f"[Jobs] Resuming ingest job {job_id}")
+        queue_job(job_id)
+
+async def _job_sweeper():
+    # picks up jobs whose owner died without releasing the lease
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECS)
+        try:
+            await requeue_unfinished_jobs()
+        except Exception as e:
+            print("[Jobs] Sweep failed:", e)
+
+async def start_job_workers():
+    """Start the background job workers and requeue jobs left unfinished by a previous run."""
+    global _job_queue
+    if _job_workers:
+        return
+    _job_queue = asyncio.Queue()
+    _queued_jobs.clear()
+    await requeue_unfinished_jobs()
+    for _ in range(max(1, JOB_WORKERS)):
+        _job_workers.append(asyncio.create_task(_job_worker()))
+    _job_workers.append(asyncio.create_task(_job_sweeper()))
+
+@on_shutdown
+async def stop_job_workers():
+    # running jobs stay 'running' in the store and are resumed on next start
+    for task in _job_workers:
+        task.cancel()
+    await asyncio.gather(*_job_workers, return_exceptions=True)
+    _job_workers.clear()
+
+async def enqueue_ingest_job(kind, source, force=False):
+    """Persist a new job ('prompt' or 'file') and hand it to the workers."""
+    await start_job_workers()
+    job = {
+        "id": uuid4().hex[:12],
+        "kind": kind,
+        "source": source,
+        "force": force,
+        "status": "queued",
+        "titles": None,
+        "results": {},
+        "stats": None,
+        "error": None,
+        "created": time.time(),
+    }
+    await save_job(job)
+    queue_job(job["id"])
+    return job["id"]
+
+async def _run_job(job):
+    job["status"] = "running"
+    await save_job(job)
+
+    if job["kind"] == "prompt":
+        if job["titles"] is None:
+            job["titles"] = await extract_titles(job["source"])
+            await save_job(job)
 
-    return f"Inserted: {at}"
+        async def one(title):
+            try:
+                result = await insert_movie_with_details(title, force=job["force"])
+            except Exception as e:
+                result = f"[Error] {e}"
+            job["results"][title] = {"result": result, "ok": insert_succeeded(result)}
+            await save_job(job)
+
+        pending = [t for t in job["titles"] if t not in job["results"]]
+        await run_bounded(one, pending, INGEST_CONCURRENCY)
+    else:
+        # the bulk checkpoint already makes file jobs resumable; keep failures only
+        def on_result(key, result, ok):
+            if not ok:
+                job["results"][key] = {"result": result, "ok": False}
+
+        job["stats"] = await bulk_ingest(job["source"], force=job["force"], on_result=on_result)
+
+    job["status"] = "done"
+    await save_job(job)
+
+async def _job_heartbeat(job):
+    # keeps the lease alive while a job stalls (open breakers, long backoffs)
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECS / 3)
+        try:
+            await save_job(job)
+        except Exception as e:
+            print(f"[Jobs] Lease renewal for {job['id']} failed:", e)
+
+async def _job_worker():
+    while True:
+        job_id = await _job_queue.get()
+        _queued_jobs.discard(job_id)
+        if job_id in _running_jobs:
+            continue
+        if not await run_blocking(job_leases.add, job_id, WORKER_ID, JOB_LEASE_SECS):
+            continue  # another server process owns it
+        # read after taking the lease so a job finished elsewhere is not rerun
+        entry = await run_blocking(ingest_jobs.get, job_id)
+        if entry is None or entry[0]["status"] in _JOB_FINISHED:
+            await run_blocking(job_leases.delete, job_id)
+            continue
+        job = entry[0]
+        task = asyncio.create_task(_run_job(job))
+        heartbeat = asyncio.create_task(_job_heartbeat(job))
+        _running_jobs[job_id] = (job, task)
+        try:
+            await task
+        except asyncio.CancelledError:
+            if job["status"] != "cancelled":
+                raise  # server shutdown, not a user cancel
+            await save_job(job)
+        except Exception as e:
+            print(f"[Jobs] Ingest job {job_id} failed:", e)
+            job["status"], job["error"] = "failed", str(e)
+            await save_job(job)
+        finally:
+            heartbeat.cancel()
+            _running_jobs.pop(job_id, None)
+            # released on shutdown too, so another replica can resume the job
+            await run_blocking(job_leases.delete, job_id)
+
+def _job_result(entry, ok):
+    # jobs stored before results carried an ok flag hold the bare result string
+    if isinstance(entry, str):
+        return {"result": entry, "ok": ok and insert_succeeded(entry)}
+    return entry
+
+def format_job(job):
+    header = f"Job {job['id']} ({job['kind']}: {job['source']}): {job['status']}"
+    lines = []
+    if job["titles"] is not None:
+        header += f", {len(job['results'])}/{len(job['titles'])} titles done"
+        for title in job["titles"]:
+            entry = job["results"].get(title)
+            if entry is None:
+                lines.append(f"⏳ {title}: pending")
+            else:
+                entry = _job_result(entry, True)
+                lines.append(f"{'✔️' if entry['ok'] else '❌'} {title}: {entry['result']}")
+    else:
+        if job["stats"]:
+            s = job["stats"]
+            header += (f", {s['inserted']} inserted, {s['skipped']} skipped, "
+                       f"{s['failed']} failed, {s['resumed']} already done")
+        lines.extend(f"❌ {key}: {_job_result(entry, False)['result']}" for key, entry in job["results"].items())
+    if job["error"]:
+        lines.append(f"[Error] {job['error']}")
+    return "\n".join([header] + lines)
+
+@mcp.tool()
+@traced
+async def get_ingest_job_status(job_id: str) -> str:
+    """
+    Report the status and per-title progress of a background ingest job.
+    """
+    running = _running_jobs.get(job_id)
+    if running:
+        return format_job(running[0])
+    entry = await run_blocking(ingest_jobs.get, job_id)
+    if entry is None:
+        return f"Unknown ingest job: {job_id}"
+    return format_job(entry[0])
+
+@mcp.tool()
+@traced
+async def cancel_ingest_job(job_id: str) -> str:
+    """
+    Cancel a queued or running background ingest job. Titles already
+    inserted stay in the graph. A job running in another server process
+    stops at its next progress update.
+    """
+    running = _running_jobs.get(job_id)
+    if running:
+        job, task = running
+        job["status"] = "cancelled"
+        task.cancel()
+        return f"Cancelling ingest job {job_id}."
+
+    entry = await run_blocking(ingest_jobs.get, job_id)
+    if entry is None:
+        return f"Unknown ingest job: {job_id}"
+    job = entry[0]
+    if job["status"] in _JOB_FINISHED:
+        return f"Ingest job {job_id} is already {job['status']}."
+    job["status"] = "cancelled"
+    await save_job(job)
+    return f"Cancelled ingest job {job_id}."
+
+@mcp.custom_route("/metrics", methods=["GET"])
+async def metrics(request):
+    """Prometheus scrape endpoint, served next to the HTTP transport."""
+    if _MULTIPROCESS_METRICS:
+        from prometheus_client import CollectorRegistry, multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@mcp.resource("stats://caches")
+def cache_stats() -> str:
+    """Hit/miss counters of the local caches."""
+    return json.dumps({name: cache.stats for name, cache in _caches.items()}, indent=2)
 
 @mcp.resource("test://{msg}")
 def test(msg: str) -> str:
     return f"ok: {msg}"
 
-# To run the MCP server remotely
-if __name__ == "__main__":
-    transport = "sse"
+async def run_bulk_cli(args):
+    def report(key, result, ok):
+        print(f"{'✔️' if ok else '❌'} {key}: {result}")
+
+    try:
+        stats = await bulk_ingest(args.path, args.checkpoint, args.force, report)
+        print(json.dumps(stats))
+    finally:
+        await run_shutdown_hooks()
+
+def create_http_app(transport=None):
+    """ASGI app for the sse or streamable-http transport.
+
+    In stateless mode the MCP lifespan runs once per request, so the app
+    holds a session slot of its own: shared clients and job workers live as
+    long as the process instead of being torn down after every call.
+    """
+    transport = transport or MCP_TRANSPORT
+    if transport == "sse":
+        app = mcp.sse_app()
+    elif transport == "streamable-http":
+        app = mcp.streamable_http_app()
+    else:
+        raise ValueError(f"Unknown HTTP transport: {transport}")
+    inner = app.router.lifespan_context
+
+    @asynccontextmanager
+    async def lifespan(app):
+        async with server_lifespan(mcp):
+            async with inner(app) as state:
+                yield state
+
+    app.router.lifespan_context = lifespan
+    return app
+
+def serve(transport, host, port, workers):
     if transport == "stdio":
         print("Running server with stdio transport")
         mcp.run(transport="stdio")
-    elif transport == "sse":
-        print("Running server with SSE transport")
-        mcp.run(transport="sse")
+        return
+    if transport == "sse" and workers > 1:
+        raise ValueError("SSE sessions are bound to one process; use streamable-http for several workers")
+    import uvicorn
+
+    print(f"Running server with {transport} transport on {host}:{port} ({workers} worker(s))")
+    if workers > 1:
+        # each worker imports this file again and builds its own app
+        os.environ["MCP_TRANSPORT"] = transport
+        here = os.path.abspath(__file__)
+        module = os.path.splitext(os.path.basename(here))[0]
+        uvicorn.run(f"{module}:create_http_app", factory=True, host=host, port=port,
+                    workers=workers, app_dir=os.path.dirname(here))
+    else:
+        uvicorn.run(create_http_app(transport), host=host, port=port)
+
+# To run the MCP server remotely
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="NeuraFlix MCP server")
+    commands = parser.add_subparsers(dest="command")
+    ingest = commands.add_parser("ingest", help="bulk-ingest a CSV/JSONL/text file of titles or IMDb ids")
+    ingest.add_argument("path")
+    ingest.add_argument("--checkpoint", help="checkpoint file (default: <path>.checkpoint.jsonl)")
+    ingest.add_argument("--force", action="store_true", help="rewrite movies that are already ingested")
+    server = commands.add_parser("serve", help="run the MCP server (the default command)")
+    server.add_argument("--transport", choices=("stdio", "sse", "streamable-http"), default=MCP_TRANSPORT)
+    server.add_argument("--host", default=MCP_HOST)
+    server.add_argument("--port", type=int, default=MCP_PORT)
+    server.add_argument("--workers", type=int, default=MCP_WORKERS)
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        asyncio.run(run_bulk_cli(args))
+        raise SystemExit(0)
+
+    if args.command == "serve":
+        serve(args.transport, args.host, args.port, args.workers)
     else:
-        raise ValueError(f"Unknown transport: {transport}")
\ No newline at end of file
+        serve(MCP_TRANSPORT, MCP_HOST, MCP_PORT, MCP_WORKERS)
\ No newline at end of file
@@ -1,5 +1,7 @@
 """ChatAgent"""
 import os
+import queue
+import threading
 import streamlit as st
 from dotenv import load_dotenv
 from langchain_groq import ChatGroq
@@ -15,6 +17,30 @@ st.set_page_config(page_title="🎬 NeuraFlix Chat Agent", layout="centered")
 st.title("🎬 NeuraFlix Chat Agent")
 st.markdown("Talk to our AI Movie Agent. Insertt movies, directors, and more!")
 
+# how long the first message waits for the MCP server to start
+STARTUP_TIMEOUT = 120
+
+class AgentLoop:
+    """Event loop on a background thread, one per Streamlit session.
+
+    Streamlit reruns this script on a new thread for every interaction, but
+    the MCP client's stdio sessions belong to the loop that opened them, so
+    all agent coroutines of a session are submitted to this long-lived loop.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="agent-loop", daemon=True)
+        self.thread.start()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+        self.loop.close()
+
 # Session state for chat history
 if "messages" not in st.session_state:
     st.session_state.messages = []
@@ -22,7 +48,7 @@ if "messages" not in st.session_state:
 if "agent" not in st.session_state:
     config_file = "neuraflix-mcp.json"
     client = MCPClient.from_config_file(config_file)
-    llm = ChatGroq(model="qwen/qwen3-32b")
+    llm = ChatGroq(model="qwen/qwen3-32b", reasoning_format="hidden")  # keep <think> out of the stream
 
     agent = MCPAgent(
         llm=llm,
@@ -33,17 +59,49 @@ if "agent" not in st.session_state:
 
     st.session_state.agent = agent
     st.session_state.client = client  # Store client for cleanup
+    st.session_state.loop = AgentLoop()
+    # start the MCP server while the user is typing the first message
+    st.session_state.warmup = st.session_state.loop.submit(agent.initialize())
 
 agent = st.session_state.agent
 
+def close_agent_session():
+    """Close the MCP sessions and stop the loop; the next rerun starts fresh."""
+    try:
+        st.session_state.loop.submit(st.session_state.client.close_all_sessions()).result(timeout=10)
+    except Exception as e:
+        print("[ChatAgent] Closing MCP sessions failed:", e)
+    st.session_state.loop.stop()
+    for key in ("agent", "client", "loop", "warmup"):
+        st.session_state.pop(key, None)
+
 # Display existing messages
 for msg in st.session_state.messages:
     with st.chat_message(msg["role"]):
         st.markdown(msg["content"])
 
-# Handle user input asynchronously
-async def handle_prompt(prompt):
-    return await agent.run(prompt)
+# Runs on the session loop; hands answer tokens and tool progress to the script thread
+async def stream_prompt(prompt, events):
+    answer = ""
+    outcome = ("error", RuntimeError("The agent run was cancelled."))
+    try:
+        async for event in agent.stream_events(prompt):
+            kind = event["event"]
+            if kind == "on_chat_model_stream":
+                token = event["data"]["chunk"].content
+                if token:
+                    answer += token
+                    events.put(("token", answer))
+            elif kind == "on_tool_start":
+                answer = ""  # text before a tool call is not the final answer
+                events.put(("tool_start", event["name"]))
+            elif kind == "on_tool_end":
+                events.put(("tool_end", event["name"]))
+        outcome = ("done", answer)
+    except Exception as e:
+        outcome = ("error", e)
+    finally:
+        events.put(outcome)  # always, so the script thread never waits forever
 
 if prompt := st.chat_input("Ask me to insert any movie..."):
     st.session_state.messages.append({"role": "user", "content": prompt})
@@ -52,14 +110,43 @@ if prompt := st.chat_input("Ask me to insert any movie..."):
 
     with st.chat_message("assistant"):
         try:
+            if not st.session_state.warmup.done():
+                with st.spinner("Starting MCP server..."):
+                    st.session_state.warmup.result(timeout=STARTUP_TIMEOUT)
+            progress = st.empty()
+            body = st.empty()
+            events = queue.Queue()
+            session_loop = st.session_state.loop
+            run = session_loop.submit(stream_prompt(prompt, events))
+            tools = []
             with st.spinner("Thinking..."):
-                response = asyncio.run(handle_prompt(prompt))
-            st.markdown(response)
-            st.session_state.messages.append({"role": "assistant", "content": response})
-        except RuntimeError as re:
-            # This handles 'asyncio.run() cannot be called from a running event loop'
-            response = asyncio.get_event_loop().run_until_complete(handle_prompt(prompt))
-            st.markdown(response)
+                while True:
+                    try:
+                        kind, value = events.get(timeout=0.5)
+                    except queue.Empty:
+                        # a stopped loop never finishes (or even starts) the coroutine
+                        if not run.done() and session_loop.thread.is_alive():
+                            continue
+                        try:
+                            kind, value = events.get_nowait()  # sent just as the wait timed out
+                        except queue.Empty:
+                            raise RuntimeError("The agent stopped without answering.")
+                    if kind == "token":
+                        body.markdown(value + "▌")
+                    elif kind == "tool_start":
+                        tools.append(f"⏳ {value}")
+                        body.empty()
+                        progress.caption(" · ".join(tools))
+                    elif kind == "tool_end":
+                        if f"⏳ {value}" in tools:
+                            tools[tools.index(f"⏳ {value}")] = f"✔️ {value}"
+                        progress.caption(" · ".join(tools))
+                    elif kind == "error":
+                        raise value
+                    else:
+                        response = value
+                        break
+            body.markdown(response)
             st.session_state.messages.append({"role": "assistant", "content": response})
         except Exception as e:
             st.error(f"Error: {e}")
@@ -67,6 +154,7 @@ if prompt := st.chat_input("Ask me to insert any movie..."):
 # Clear memory button
 if st.button("🧹 Clear Chat & Memory"):
     agent.clear_conversation_history()
+    close_agent_session()
     st.session_state.messages = []
     st.rerun()
 
@@ -0,0 +1,28 @@
+"""Poster thumbnail rendering.
+
+Kept in its own small module so the process pool pickles
+`render_variants` by a stable module name, whether the server runs as
+a script, under uvicorn's factory import or loaded by benchmark.py
+under another name.
+"""
+import io
+from PIL import Image
+
+def render_variants(data, widths, quality=75):
+    """Resize a poster to each width and encode it as WebP.
+
+    Returns a list of (width, webp bytes). Widths at or above the source
+    width are left out, since upscaling would only add bytes; the caller
+    serves the original for those.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert("RGB")
+        variants = []
+        for width in sorted(set(widths)):
+            if width >= image.width:
+                continue
+            height = max(1, round(image.height * width / image.width))
+            out = io.BytesIO()
+            image.resize((width, height), Image.LANCZOS).save(out, "WEBP", quality=quality, method=6)
+            variants.append((width, out.getvalue()))
+        return variants